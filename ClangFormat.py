@@ -11,6 +11,9 @@
 # It operates on the current, potentially unsaved buffer and does not create
 # or save any files. To revert a formatting, just undo.
 
+import asyncio
+import codecs
+import difflib
 import os
 import sys
 import sublime
@@ -18,6 +21,11 @@ import sublime_plugin
 import subprocess
 import threading
 
+from shutil import which
+
+if sys.platform != 'win32':
+    import fcntl
+
 from sublime_lib import ActivityIndicator
 
 PREF_CLANG_FORMAT_PATH = 'clang_format_path'
@@ -25,60 +33,112 @@ PREF_FILE_NAME = 'ClangFormat (%s).sublime-settings'
 MISSING_BINARY_MESSAGE = 'ClangFormat\n\nTo format the code, either full path to the \
 clang-format binary must be specified in the package settings or %s binary must be in the PATH!'
 
+# These never change within a process so compute them once at import instead
+# of re-deriving them from sys.platform on every format.
+_PLATFORM = 'linux' if sys.platform.startswith('linux') else 'mac' if sys.platform == 'darwin' else 'windows'
+_SETTINGS_FILENAME = PREF_FILE_NAME % {'linux': 'Linux', 'mac': 'OSX', 'windows': 'Windows'}[_PLATFORM]
+_BINARY_NAME = 'clang-format.exe' if _PLATFORM == 'windows' else 'clang-format'
 
-def start_thread(on_exit, on_error, popen_args, stdin):
-    """
-    Runs the given args in a subprocess.Popen, and then calls the function
-    on_exit when the subprocess completes.
-    on_exit is a callable object, and popen_args is a list/tuple of args that
-    on_error when the subprocess throws an error
-    would give to subprocess.Popen.
-    """
-    def run_in_thread(on_exit, on_error, popen_args):
-        startupinfo = None
-        # Don't let console window pop-up on Windows.
-        if platform_name() == 'windows':
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-        process = subprocess.Popen(popen_args,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   stdin=subprocess.PIPE,
-                                   startupinfo=startupinfo)
-        output, error = process.communicate(stdin)
-
-        if error:
-            on_error(error)
-        else:
-            on_exit(output)
+# How many characters to encode per stdin chunk when streaming.
+_ENCODE_CHUNK_CHARS = 65536
 
-    thread = threading.Thread(target=run_in_thread, args=(on_exit, on_error, popen_args))
-    thread.start()
-    # returns immediately after the thread starts
-    return thread
 
+# Formatting jobs run as coroutines on a single asyncio event loop hosted by
+# one daemon thread. The loop multiplexes all subprocess pipes itself, so many
+# concurrent jobs (rapid keypresses, parallel shards) share that one thread,
+# and a pending job can be cancelled when a newer format supersedes it.
+_loop = None
+_loop_lock = threading.Lock()
 
-def platform_name():
-    if 'linux' in sys.platform:
-        return 'linux'
-    elif 'darwin' in sys.platform:
-        return 'mac'
-    return 'windows'
 
+def _event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
 
-def settings_filename():
-    if 'linux' in sys.platform:
-        return PREF_FILE_NAME % 'Linux'
-    elif 'darwin' in sys.platform:
-        return PREF_FILE_NAME % 'OSX'
-    return PREF_FILE_NAME % 'Windows'
+
+def submit_job(popen_args, stdin_chunks, on_exit, on_error):
+    """
+    Schedules a formatting job on the event loop and returns its future, which
+    may be cancelled while the job is in flight. on_exit is called with the
+    formatted output when the job completes, or on_error with the error output
+    if it fails. stdin_chunks is an iterable of encoded byte chunks which may
+    be produced lazily.
+
+    clang-format has no persistent server mode, so each job spawns a fresh
+    process. Keeping all spawning behind this single entry point means a
+    long-lived worker could be swapped in here without touching call sites.
+    """
+    return asyncio.run_coroutine_threadsafe(
+        _run_job(popen_args, stdin_chunks, on_exit, on_error), _event_loop())
 
 
-def binary_name():
-    if 'win32' in sys.platform:
-        return 'clang-format.exe'
-    return 'clang-format'
+async def _run_job(popen_args, stdin_chunks, on_exit, on_error):
+    kwargs = {}
+    if _PLATFORM == 'windows':
+        # Don't let console window pop-up on Windows.
+        kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
+    else:
+        # With no preexec_fn, no shell and inheritable fds, subprocess takes
+        # its posix_spawn fast path instead of a full fork+exec. The plugin
+        # host has no sensitive fds to leak to clang-format.
+        kwargs['close_fds'] = False
+    try:
+        process = await asyncio.create_subprocess_exec(*popen_args,
+                                                       stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE,
+                                                       **kwargs)
+    except OSError as exception:
+        on_error(str(exception))
+        return
+    if _PLATFORM == 'linux':
+        _grow_pipes(process)
+    try:
+        _, output, error = await asyncio.gather(_feed_stdin(process, stdin_chunks),
+                                                process.stdout.read(),
+                                                process.stderr.read())
+        await process.wait()
+    except asyncio.CancelledError:
+        # Superseded by a newer format - don't leave the process behind.
+        process.kill()
+        raise
+    if error:
+        on_error(error)
+    else:
+        on_exit(output)
+
+
+async def _feed_stdin(process, stdin_chunks):
+    # Chunks are pulled lazily, so when they come from an incremental encoder
+    # the encode overlaps with the process parsing the earlier input.
+    try:
+        for chunk in stdin_chunks:
+            process.stdin.write(chunk)
+            await process.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The process exited early - its error output will tell.
+        pass
+    finally:
+        process.stdin.close()
+
+
+def _grow_pipes(process):
+    # Grow the stdin/stdout pipes from the kernel's 64 KB default so large
+    # buffers move with fewer write/read handoffs. Best effort: sizes above
+    # /proc/sys/fs/pipe-max-size need CAP_SYS_RESOURCE, and reaching the
+    # underlying pipe objects goes through the process transport.
+    F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+    for fd in (0, 1):
+        try:
+            pipe = process._transport.get_pipe_transport(fd).get_extra_info('pipe')
+            fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, 1 << 20)
+        except (AttributeError, OSError, ValueError):
+            # Includes the process having already exited and closed its pipes.
+            pass
 
 
 # Change this to format according to other formatting styles
@@ -86,91 +146,312 @@ def binary_name():
 style = 'Chromium'
 
 
-def is_exe(fpath):
-    return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+# Cached result of resolving the clang-format binary, as a tuple of
+# (clang_format_path setting, PATH environment value, resolved path). Looking
+# the binary up stats every directory in PATH, so avoid redoing it on every
+# format invocation.
+_binary_cache = None
 
 
-def which(program):
-    fpath, fname = os.path.split(program)
-    if fpath:
-        if is_exe(program):
-            return program
-    else:
-        for path in os.environ['PATH'].split(os.pathsep):
-            path = path.strip('"')
-            exe_file = os.path.join(path, program)
-            if is_exe(exe_file):
-                return exe_file
+def resolve_binary(path_setting):
+    """
+    Returns the path of the clang-format binary to use, or None if not found.
+
+    The result is memoized so that repeated formats don't rescan PATH. The
+    cache is keyed on the relevant inputs and dropped in plugin_loaded().
+    """
+    global _binary_cache
+    key = (path_setting or '', os.environ.get('PATH', ''))
+    if _binary_cache and _binary_cache[:2] == key:
+        return _binary_cache[2]
+    # shutil.which checks existence and executability in one pass and knows
+    # about PATHEXT wrappers like .cmd/.bat on Windows; it also accepts a full
+    # path, covering the explicit clang_format_path setting.
+    binary_path = which(path_setting or _BINARY_NAME)
+    _binary_cache = key + (binary_path,)
+    return binary_path
+
+
+# Bumped whenever the package settings change so that per-view caches keyed on
+# it are invalidated.
+_settings_generation = 0
+
+# Loaded once in plugin_loaded(); the clang_format_path value is mirrored into
+# _binary_path_setting so the hot path doesn't go through the settings bridge
+# on every format.
+_settings = None
+_binary_path_setting = None
+
+
+def _on_settings_change():
+    global _binary_cache, _binary_path_setting, _settings_generation
+    _binary_cache = None
+    _binary_path_setting = _settings.get(PREF_CLANG_FORMAT_PATH)
+    _settings_generation += 1
+
 
-    return None
+def plugin_loaded():
+    global _binary_cache, _binary_path_setting, _settings
+    _binary_cache = None
+    _settings = sublime.load_settings(_SETTINGS_FILENAME)
+    _binary_path_setting = _settings.get(PREF_CLANG_FORMAT_PATH)
+    _settings.clear_on_change(PREF_CLANG_FORMAT_PATH)
+    _settings.add_on_change(PREF_CLANG_FORMAT_PATH, _on_settings_change)
+
+
+def _ascii_fast_encodable(text, encoding):
+    # ASCII-only text (the typical source file) encodes byte-identically and
+    # memcpy-fast through the ascii codec when the target encoding is an
+    # ASCII superset like UTF-8.
+    return codecs.lookup(encoding).name in ('ascii', 'utf-8') and text.isascii()
+
+
+def line_edits(old_lines, new_lines):
+    """
+    Returns the minimal (start, end, replacement) edits, with start/end being
+    character offsets into the original text, turning old_lines into
+    new_lines. Both arguments are splitlines(keepends=True) lists.
+    """
+    offsets = [0]
+    for line in old_lines:
+        offsets.append(offsets[-1] + len(line))
+    matcher = difflib.SequenceMatcher(a=old_lines, b=new_lines, autojunk=False)
+    return [(offsets[i1], offsets[i2], ''.join(new_lines[j1:j2]))
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
 
 
 class ClangFormatCommand(sublime_plugin.TextCommand):
     def __init__(self, view):
         super().__init__(view)
         self._indicator = None
-
-    def run(self, edit, only_selection=True):
-        settings = sublime.load_settings(settings_filename())
-        binary_path = settings.get(PREF_CLANG_FORMAT_PATH)
+        self._in_flight = False
+        self._last_key = None
+        self._last_result = None
+        self._encoded_cache = None
+        self._base_args_cache = None
+        self._job_futures = []
+
+    def encoded_buffer(self, encoding):
+        """
+        Returns the full buffer content as a (text, encoded bytes) pair,
+        memoized on the view's change_count so repeated formats share a single
+        substr() and encode.
+        """
+        change_count = self.view.change_count()
+        if self._encoded_cache and self._encoded_cache[:2] == (change_count, encoding):
+            return self._encoded_cache[2:]
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        encoded = text.encode('ascii' if _ascii_fast_encodable(text, encoding) else encoding)
+        self._encoded_cache = (change_count, encoding, text, encoded)
+        return text, encoded
+
+    def buffer_chunks(self, encoding):
+        """
+        Returns the buffer as (text, chunks) where chunks is an iterable of
+        encoded byte chunks covering the full buffer. On a cache hit chunks is
+        the single already-encoded blob; otherwise the chunks come lazily from
+        an incremental encoder, so writing them to clang-format overlaps the
+        encode with its parsing, and the concatenation is stored back into the
+        cache for the next format.
+        """
+        change_count = self.view.change_count()
+        if self._encoded_cache and self._encoded_cache[:2] == (change_count, encoding):
+            return self._encoded_cache[2], [self._encoded_cache[3]]
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        if _ascii_fast_encodable(text, encoding):
+            # The ascii encode is a plain memcpy, so there is nothing worth
+            # overlapping with the incremental encoder.
+            encoded = text.encode('ascii')
+            self._encoded_cache = (change_count, encoding, text, encoded)
+            return text, [encoded]
+        return text, self._encode_streaming(text, encoding, change_count)
+
+    def _encode_streaming(self, text, encoding, change_count):
+        encoder = codecs.getincrementalencoder(encoding)()
+        parts = []
+        for start in range(0, len(text), _ENCODE_CHUNK_CHARS):
+            chunk = encoder.encode(text[start:start + _ENCODE_CHUNK_CHARS],
+                                   start + _ENCODE_CHUNK_CHARS >= len(text))
+            parts.append(chunk)
+            yield chunk
+        self._encoded_cache = (change_count, encoding, text, b''.join(parts))
+
+    def run(self, edit, only_selection=True, edits=None):
+        if edits is not None:
+            # Re-dispatched from a formatting callback with the result;
+            # apply it here using this command's own edit token instead of
+            # going through a separate apply command.
+            self.apply(edit, edits)
+            return
+
+        if _settings is None:
+            plugin_loaded()
+        binary_path = resolve_binary(_binary_path_setting)
         if not binary_path:
-            binary_path = which(binary_name())
-            if not binary_path or not is_exe(binary_path):
-                sublime.message_dialog(MISSING_BINARY_MESSAGE % binary_name())
-                return
-
-        args = [binary_path, '-fallback-style', style]
-        if self.view.file_name():
-            args.extend(['-assume-filename', self.view.file_name()])
-        else:
-            print('Checking style without knowing file type. Results might be innacurate!')
-
-        if only_selection:
-            for region in self.view.sel():
-                region_offset = min(region.a, region.b)
-                region_length = abs(region.b - region.a)
-                args.extend(['-offset', str(region_offset), '-length', str(region_length)])
-
-        buffer_text = self.view.substr(sublime.Region(0, self.view.size()))
+            sublime.message_dialog(MISSING_BINARY_MESSAGE % _BINARY_NAME)
+            return
+
+        # If neither the buffer nor the selection changed since the last
+        # format, skip the subprocess round-trip entirely.
+        key = (self.view.change_count(), tuple((r.a, r.b) for r in self.view.sel()),
+               style, only_selection, _settings_generation)
+        if key == self._last_key:
+            if self._last_result is not None:
+                self.apply_result(self._last_result)
+            # Otherwise an identical format is already in flight.
+            return
+        self._last_key = key
+        self._last_result = None
+        # A newer format supersedes any jobs still in flight for this view;
+        # rapid keypress bursts collapse to the latest one.
+        self.cancel_pending_jobs()
+
+        args = self.base_args(binary_path)
         encoding = self.view.encoding()
         encoding = encoding if encoding != 'Undefined' else 'utf-8'
-        stdin = buffer_text.encode(encoding)
-        viewport_pos = self.view.viewport_position()
-        # Show progress indicator if formatting takes longer than 1s.
-        self._indicator = ActivityIndicator(self.view, 'ClangFormat: Formatting...')
-        sublime.set_timeout(self.start_indicator, 1000)
-
-        start_thread(
-            lambda output: self.on_formatting_success(viewport_pos, output, encoding),
-            self.on_formatting_error,
+        # Show a progress indicator if formatting takes longer than 1s. The
+        # indicator itself is only constructed if that actually happens.
+        self._in_flight = True
+        sublime.set_timeout(self.maybe_start_indicator, 1000)
+
+        regions = list(self.view.sel()) if only_selection else []
+        if len(regions) > 1:
+            # Parallel shards feed several processes, so they need the fully
+            # encoded buffer rather than a one-shot chunk stream.
+            text, stdin = self.encoded_buffer(encoding)
+            self.start_parallel_jobs(args, regions, text, stdin, encoding)
+            return
+        if regions:
+            # Concatenate rather than extend - args is the cached base list.
+            args = args + self.lines_args(regions)
+
+        text, chunks = self.buffer_chunks(encoding)
+        self._job_futures.append(submit_job(
             args,
-            stdin
-        )
+            chunks,
+            lambda output: self.on_formatting_success(text, output, encoding),
+            self.on_formatting_error
+        ))
+
+    def cancel_pending_jobs(self):
+        for future in self._job_futures:
+            future.cancel()
+        self._job_futures.clear()
+
+    def base_args(self, binary_path):
+        """
+        Returns the region-independent part of the clang-format command line,
+        cached per (binary, filename) since it only varies when the view is
+        renamed or the settings change, not per keypress.
+        """
+        file_name = self.view.file_name()
+        key = (binary_path, file_name, _settings_generation)
+        if self._base_args_cache and self._base_args_cache[0] == key:
+            return self._base_args_cache[1]
+        args = [binary_path, '-fallback-style', style]
+        if file_name:
+            args.extend(['-assume-filename', file_name])
+        else:
+            print('Checking style without knowing file type. Results might be innacurate!')
+        self._base_args_cache = (key, args)
+        return args
+
+    def lines_args(self, regions):
+        # Preallocate instead of growing the list two items at a time - with
+        # hundreds of cursors the repeated resizing adds up.
+        args = ['-lines'] * (2 * len(regions))
+        rowcol = self.view.rowcol
+        for index, region in enumerate(regions):
+            # -lines takes 1-based inclusive line numbers and lets
+            # clang-format limit its work to the affected ranges.
+            args[2 * index + 1] = '%d:%d' % (rowcol(region.begin())[0] + 1, rowcol(region.end())[0] + 1)
+        return args
+
+    def start_parallel_jobs(self, base_args, regions, text, stdin, encoding):
+        """
+        Formats disjoint regions with parallel clang-format processes, one per
+        shard of regions, and merges the per-shard results into a single list
+        of edits. clang-format handles all -lines ranges sequentially within
+        one process, so sharding gives a near-linear speedup for multi-cursor
+        formats on multi-core machines.
+        """
+        # Cap the shard count to avoid oversubscribing the machine.
+        shard_count = min(len(regions), (os.cpu_count() or 1) * 2)
+        shards = [regions[i::shard_count] for i in range(shard_count)]
+        outputs = [None] * shard_count
+        state = {'pending': shard_count, 'error': None}
+        lock = threading.Lock()
+
+        def on_shard_done(index, output, error):
+            with lock:
+                if error:
+                    state['error'] = error
+                else:
+                    outputs[index] = output
+                state['pending'] -= 1
+                if state['pending']:
+                    return
+            if state['error']:
+                self.on_formatting_error(state['error'])
+            else:
+                self.on_parallel_formatting_success(outputs, text, encoding)
+
+        for index, shard in enumerate(shards):
+            self._job_futures.append(submit_job(
+                base_args + self.lines_args(shard),
+                [stdin],
+                lambda output, index=index: on_shard_done(index, output, None),
+                lambda error, index=index: on_shard_done(index, None, error)
+            ))
+
+    def apply_result(self, result):
+        self.view.run_command('clang_format', dict(result))
+
+    def apply(self, edit, edits):
+        self.view.window().status_message('ClangFormat: Formatted')
+        # Only the changed runs are replaced, so unchanged text keeps its
+        # regions, scopes and the viewport position - no full-buffer replace
+        # and no viewport-restore hack needed.
+        # Apply back-to-front so that earlier offsets stay valid.
+        for start, end, replacement in reversed(edits):
+            self.view.replace(edit, sublime.Region(start, end), replacement)
+
+    def on_formatting_success(self, text, output, encoding):
+        self.stop_indicator()
+        edits = line_edits(text.splitlines(keepends=True),
+                           output.decode(encoding).splitlines(keepends=True))
+        self._last_result = {'edits': edits}
+        self.apply_result(self._last_result)
 
-    def on_formatting_success(self, viewport_pos, output, encoding):
+    def on_parallel_formatting_success(self, outputs, text, encoding):
         self.stop_indicator()
-        self.view.run_command('clang_format_apply', {
-            'output': output.decode(encoding),
-            'viewport_pos': viewport_pos,
-        })
+        old_lines = text.splitlines(keepends=True)
+        edits = []
+        for output in outputs:
+            edits.extend(line_edits(old_lines, output.decode(encoding).splitlines(keepends=True)))
+        edits.sort(key=lambda edit: edit[0])
+        merged = []
+        for edit in edits:
+            # Shards format disjoint line ranges so their edits shouldn't
+            # overlap, but don't corrupt the buffer if they ever do.
+            if merged and (edit[0] < merged[-1][1] or edit == merged[-1]):
+                continue
+            merged.append(edit)
+        self._last_result = {'edits': merged}
+        self.apply_result(self._last_result)
 
     def on_formatting_error(self, error):
         self.stop_indicator()
+        self._last_key = None
         self.view.window().status_message('ClangFormat: Formatting error: %s' % error)
 
-    def start_indicator(self):
-        if self._indicator:
+    def maybe_start_indicator(self):
+        if self._in_flight and not self._indicator:
+            self._indicator = ActivityIndicator(self.view, 'ClangFormat: Formatting...')
             self._indicator.start()
 
     def stop_indicator(self):
+        self._in_flight = False
         if self._indicator:
             self._indicator.stop()
             self._indicator = None
-
-
-class ClangFormatApplyCommand(sublime_plugin.TextCommand):
-    def run(self, edit, output, viewport_pos):
-        self.view.window().status_message('ClangFormat: Formatted')
-        self.view.replace(edit, sublime.Region(0, self.view.size()), output)
-        # FIXME: Without the 10ms delay, the viewport sometimes jumps.
-        sublime.set_timeout_async(lambda: self.view.set_viewport_position(viewport_pos, False), 10)